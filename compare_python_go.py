@@ -1,18 +1,41 @@
 #!/usr/bin/env python3
 
+import gzip
 import math
 import os
 import sqlite3
 import sys
 import requests
-import json
+import orjson
 import re
 import time
+import numpy as np
 import pandas as pd
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from operator import itemgetter
+from requests.adapters import HTTPAdapter
 
 VMAAS_PY_URL = "http://localhost:8080/api/vmaas/v3/vulnerabilities"
 VMAAS_GO_URL = "http://localhost:8000/api/vmaas/v3/vulnerabilities"
 
+# Keep-Alive sessions so handshakes are not part of the measured durations
+SESSION_PY = requests.Session()
+SESSION_PY.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=32))
+SESSION_GO = requests.Session()
+SESSION_GO.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=32))
+# Gzip request bodies only when asked for, VMaaS needs to accept them and on localhost it only costs CPU
+VMAAS_GZIP = os.getenv("VMAAS_GZIP", "")
+JSON_HEADERS = {"Content-Type": "application/json"}
+if VMAAS_GZIP:
+    JSON_HEADERS["Content-Encoding"] = "gzip"
+
+# Systems probed concurrently, set VMAAS_WORKERS=1 to measure latency of single requests without load
+WORKERS = int(os.getenv("VMAAS_WORKERS", "16"))
+MAX_PENDING = WORKERS * 4  # Systems read from DB ahead of the workers
+
+CVE_KEY = itemgetter("cve")
+CVE_LISTS = ("cve_list", "manually_fixable_cve_list", "unpatched_cve_list")
+
 NEVRA_RE = re.compile(
     r'((?P<e1>[0-9]+):)?(?P<pn>[^:]+)(?(e1)-|-((?P<e2>[0-9]+):)?)(?P<ver>[^-:]+)-(?P<rel>[^-:]+)\.(?P<arch>[a-z0-9_]+)')
 
@@ -50,14 +73,35 @@ def parse_rpm_name(rpm_name, default_epoch=None, raise_exception=False):
     return name, epoch, version, release, arch
 
 
+def extended_request(vmaas_json):
+    """
+    Set "extended" flag directly in stored vmaas request JSON to avoid decoding and encoding it again.
+    """
+    head = vmaas_json.rstrip()[:-1].rstrip()
+    separator = "" if head.endswith("{") else ","
+    body = f'{head}{separator}"extended":true}}'.encode("utf-8")
+    if VMAAS_GZIP:
+        body = gzip.compress(body, compresslevel=1)
+    return body
+
+
 class SqliteConnection:
-    def __init__(self, db_file_name: str):
+    def __init__(self, db_file_name: str, read_only: bool = False):
         self.db_file_name = db_file_name
+        self.read_only = read_only
         self.con = None
 
     def __enter__(self) -> sqlite3.Connection:
         self.con = sqlite3.connect(self.db_file_name)
-        self.con.execute("PRAGMA foreign_keys = ON")  # Enforce foreign keys
+        if self.read_only:
+            self.con.execute("PRAGMA query_only = ON")
+            self.con.execute("PRAGMA mmap_size = 268435456")  # 256 MiB memory-mapped I/O
+            self.con.execute("PRAGMA cache_size = -262144")  # 256 MiB page cache
+        else:
+            self.con.execute("PRAGMA foreign_keys = ON")  # Enforce foreign keys
+            self.con.execute("PRAGMA journal_mode = WAL")
+            self.con.execute("PRAGMA synchronous = NORMAL")  # Safe with WAL, no fsync per commit
+            self.con.execute("PRAGMA temp_store = MEMORY")
         return self.con
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -67,12 +111,12 @@ class SqliteConnection:
 
 
 class SqliteCursor:
-    def __init__(self, sqlite_connection: SqliteConnection):
+    def __init__(self, sqlite_connection: sqlite3.Connection):
         self.con = sqlite_connection
         self.cur = None
 
     def __enter__(self) -> sqlite3.Cursor:
-        self.cur = sqlite3.Cursor(self.con)
+        self.cur = self.con.cursor()
         return self.cur
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -81,82 +125,116 @@ class SqliteCursor:
             self.cur = None
 
 
+def count_systems(cur, system_limit):
+    """
+    Get upper bound of number of systems the queries below can return.
+    Counting all rows only reads the inventory_id index, filtering out empty profiles would read all profiles.
+    """
+    cur.execute("SELECT COUNT(*) FROM system")
+    return min(system_limit, cur.fetchone()[0])
+
+
+def systems(cur, system_limit):
+    """
+    Yield inventory ID and encoded vmaas request of each system.
+    """
+    cur.execute("SELECT inventory_id, vmaas_json FROM system WHERE vmaas_json != '' ORDER by inventory_id LIMIT ?", (system_limit,))
+    for inventory_id, vmaas_json in cur:
+        yield inventory_id, extended_request(vmaas_json)
+
+
+def probe_one(inventory_id, body):
+    """
+    Send the same request to vmaas-py and vmaas-go sequentially and time both.
+    """
+    start_ts = time.time()
+    resp_py = SESSION_PY.post(VMAAS_PY_URL, data=body, headers=JSON_HEADERS)
+    py_done_ts = time.time()
+    resp_go = SESSION_GO.post(VMAAS_GO_URL, data=body, headers=JSON_HEADERS)
+    go_done_ts = time.time()
+
+    py_duration = py_done_ts - start_ts
+    go_duration = go_done_ts - py_done_ts
+
+    vulns_py = orjson.loads(resp_py.content) if resp_py.status_code == 200 else None
+    if resp_go.status_code == 200 and resp_go.content == resp_py.content:
+        vulns_go = vulns_py  # Identical responses, CVE lists compare by identity
+    else:
+        vulns_go = orjson.loads(resp_go.content) if resp_go.status_code == 200 else None
+    return inventory_id, py_duration, go_duration, vulns_py, vulns_go, resp_py.status_code, resp_go.status_code
+
+
+def probe_all(pool, systems):
+    """
+    Probe systems in the pool and yield results in order of completion.
+    """
+    pending = set()
+    for inventory_id, body in systems:
+        pending.add(pool.submit(probe_one, inventory_id, body))
+        if len(pending) >= MAX_PENDING:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    for future in as_completed(pending):
+        yield future.result()
+
+
+def diff_cves(inventory_id, list_name, cve_list_py, cve_list_go):
+    """
+    Print differences between CVE lists returned from vmaas-py and vmaas-go.
+    """
+    if cve_list_py == cve_list_go:
+        return
+    if len(cve_list_py) != len(cve_list_go):
+        print(f"system {inventory_id} has {list_name} len {len(cve_list_py)} from vmaas-py")
+        print(f"system {inventory_id} has {list_name} len {len(cve_list_go)} from vmaas-go")
+    cves_py = set(map(CVE_KEY, cve_list_py))
+    cves_go = set(map(CVE_KEY, cve_list_go))
+    cves_py_not_in_go = cves_py - cves_go
+    cves_go_not_in_py = cves_go - cves_py
+    if cves_py_not_in_go:
+        print(f"system {inventory_id} has {list_name} from vmaas-py which is not in vmaas-go: {cves_py_not_in_go}")
+    if cves_go_not_in_py:
+        print(f"system {inventory_id} has {list_name} from vmaas-go which is not in vmaas-py: {cves_go_not_in_py}")
+
+
+def report(inventory_id, status_py, status_go, vulns_py, vulns_go):
+    """
+    Print differences between vmaas-py and vmaas-go responses.
+    """
+    if status_py != status_go:
+        print(f"system {inventory_id} returned HTTP {status_py} from vmaas-py")
+        print(f"system {inventory_id} returned HTTP {status_go} from vmaas-go")
+
+    if status_py == 200 and status_go == 200:
+        for list_name in CVE_LISTS:
+            diff_cves(inventory_id, list_name, vulns_py[list_name], vulns_go[list_name])
+
+
 def main():
-    if len(sys.argv) != 3:
+    if len(sys.argv) != 3 or not sys.argv[2].isdecimal():
         print(f"Usage: {sys.argv[0]} <sqlite_file> <limit>", file=sys.stderr)
         sys.exit(1)
     sqlite_file = sys.argv[1]
-    system_limit = sys.argv[2]
+    system_limit = int(sys.argv[2])
 
-    durations_py = []
-    durations_go = []
+    durations_py = np.empty(0)
+    durations_go = np.empty(0)
+    probed = 0
 
-    with SqliteConnection(sqlite_file) as con:
+    with SqliteConnection(sqlite_file, read_only=True) as con:
         with SqliteCursor(con) as cur:
             try:
-                cur.execute(f"SELECT inventory_id, vmaas_json FROM system WHERE vmaas_json != '' ORDER by inventory_id LIMIT {system_limit}")
-                system = cur.fetchone()
-                while system:
-                    inventory_id, vmaas_json = system
-                    vmaas_json = json.loads(vmaas_json)
-                    vmaas_json["extended"] = True
-
-                    start_ts = time.time()
-                    resp_py = requests.post(VMAAS_PY_URL, json=vmaas_json)
-                    py_done_ts = time.time()
-                    resp_go = requests.post(VMAAS_GO_URL, json=vmaas_json)
-                    go_done_ts = time.time()
-
-                    py_duration = py_done_ts - start_ts
-                    go_duration = go_done_ts - py_done_ts
-                    durations_py.append(py_duration)
-                    durations_go.append(go_duration)
-
-                    if resp_py.status_code != resp_go.status_code:
-                        print(f"system {inventory_id} returned HTTP {resp_py.status_code} from vmaas-py")
-                        print(f"system {inventory_id} returned HTTP {resp_go.status_code} from vmaas-go")
-                    
-                    if resp_py.status_code == 200 and resp_go.status_code == 200:
-                        vulns_py = resp_py.json()
-                        vulns_go = resp_go.json()
-
-                        fixed_cves_py = {cve["cve"] for cve in vulns_py["cve_list"]}
-                        fixed_cves_go = {cve["cve"] for cve in vulns_go["cve_list"]}
-                        fixed_cves_py_not_in_go = {cve for cve in fixed_cves_py if cve not in fixed_cves_go}
-                        fixed_cves_go_not_in_py = {cve for cve in fixed_cves_go if cve not in fixed_cves_py}
-                        if len(vulns_py["cve_list"]) != len(vulns_go["cve_list"]):
-                            print(f"system {inventory_id} has cve_list len {len(vulns_py['cve_list'])} from vmaas-py")
-                            print(f"system {inventory_id} has cve_list len {len(vulns_go['cve_list'])} from vmaas-go")
-                        if fixed_cves_py_not_in_go:
-                            print(f"system {inventory_id} has cve_list from vmaas-py which is not in vmaas-go: {fixed_cves_py_not_in_go}")
-                        if fixed_cves_go_not_in_py:
-                            print(f"system {inventory_id} has cve_list from vmaas-go which is not in vmaas-py: {fixed_cves_go_not_in_py}")
-                        
-                        manual_cves_py = {cve["cve"] for cve in vulns_py["manually_fixable_cve_list"]}
-                        manual_cves_go = {cve["cve"] for cve in vulns_go["manually_fixable_cve_list"]}
-                        manual_cves_py_not_in_go = {cve for cve in manual_cves_py if cve not in manual_cves_go}
-                        manual_cves_go_not_in_py = {cve for cve in manual_cves_go if cve not in manual_cves_py}
-                        if len(vulns_py["manually_fixable_cve_list"]) != len(vulns_go["manually_fixable_cve_list"]):
-                            print(f"system {inventory_id} has manually_fixable_cve_list len {len(vulns_py['manually_fixable_cve_list'])} from vmaas-py")
-                            print(f"system {inventory_id} has manually_fixable_cve_list len {len(vulns_go['manually_fixable_cve_list'])} from vmaas-go")
-                        if manual_cves_py_not_in_go:
-                            print(f"system {inventory_id} has manually_fixable_cve_list from vmaas-py which is not in vmaas-go: {manual_cves_py_not_in_go}")
-                        if manual_cves_go_not_in_py:
-                            print(f"system {inventory_id} has manually_fixable_cve_list from vmaas-go which is not in vmaas-py: {manual_cves_go_not_in_py}")
-
-                        unpatched_cves_py = {cve["cve"] for cve in vulns_py["unpatched_cve_list"]}
-                        unpatched_cves_go = {cve["cve"] for cve in vulns_go["unpatched_cve_list"]}
-                        unpatched_cves_py_not_in_go = {cve for cve in unpatched_cves_py if cve not in unpatched_cves_go}
-                        unpatched_cves_go_not_in_py = {cve for cve in unpatched_cves_go if cve not in unpatched_cves_py}            
-                        if len(vulns_py["unpatched_cve_list"]) != len(vulns_go["unpatched_cve_list"]):
-                            print(f"system {inventory_id} has unpatched_cve_list len {len(vulns_py['unpatched_cve_list'])} from vmaas-py")
-                            print(f"system {inventory_id} has unpatched_cve_list len {len(vulns_go['unpatched_cve_list'])} from vmaas-go")
-                        if unpatched_cves_py_not_in_go:
-                            print(f"system {inventory_id} has unpatched_cve_list from vmaas-py which is not in vmaas-go: {unpatched_cves_py_not_in_go}")
-                        if unpatched_cves_go_not_in_py:
-                            print(f"system {inventory_id} has unpatched_cve_list from vmaas-go which is not in vmaas-py: {unpatched_cves_go_not_in_py}")
-
-                    system = cur.fetchone()
+                system_count = count_systems(cur, system_limit)
+                durations_py = np.empty(system_count)
+                durations_go = np.empty(system_count)
+                with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+                    for result in probe_all(pool, systems(cur, system_limit)):
+                        inventory_id, py_duration, go_duration, vulns_py, vulns_go, status_py, status_go = result
+                        durations_py[probed] = py_duration
+                        durations_go[probed] = go_duration
+                        probed += 1
+                        report(inventory_id, status_py, status_go, vulns_py, vulns_go)
 
             except sqlite3.DatabaseError as e:
                 con.rollback()
@@ -164,12 +242,12 @@ def main():
     
     print("")
     print("Python durations:")
-    s = pd.Series(durations_py)
+    s = pd.Series(durations_py[:probed])
     print(s.describe())
 
     print("")
     print("Go durations:")
-    s = pd.Series(durations_go)
+    s = pd.Series(durations_go[:probed])
     print(s.describe())
 
 
@@ -1,17 +1,36 @@
 #!/usr/bin/env python3
 
+import gzip
 import math
 import os
 import sqlite3
 import sys
 import requests
-import json
+import numpy as np
+import orjson
 import re
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from operator import itemgetter
+from requests.adapters import HTTPAdapter
 
 VMAAS_URL = "http://localhost:8080/api/vmaas/v3/vulnerabilities"
 
+BATCH_SIZE = 100  # Systems sent to vmaas concurrently
+
+# Keep-Alive session reused for all evaluated systems
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=BATCH_SIZE))
+# Gzip request bodies only when asked for, VMaaS needs to accept them and on localhost it only costs CPU
+VMAAS_GZIP = os.getenv("VMAAS_GZIP", "")
+JSON_HEADERS = {"Content-Type": "application/json"}
+if VMAAS_GZIP:
+    JSON_HEADERS["Content-Encoding"] = "gzip"
+
 NEVRA_RE = re.compile(
     r'((?P<e1>[0-9]+):)?(?P<pn>[^:]+)(?(e1)-|-((?P<e2>[0-9]+):)?)(?P<ver>[^-:]+)-(?P<rel>[^-:]+)\.(?P<arch>[a-z0-9_]+)')
+ARCH_CHARS = frozenset("abcdefghijklmnopqrstuvwxyz0123456789_")
 
 
 
@@ -47,14 +66,61 @@ def parse_rpm_name(rpm_name, default_epoch=None, raise_exception=False):
     return name, epoch, version, release, arch
 
 
+@lru_cache(maxsize=65536)
+def parse_rpm_name_only(rpm_name):
+    """
+    Extract only name from rpm name, empty string if it can't be parsed.
+    Well-formed names are split from the right, NEVRA regex is used only for the others.
+    """
+    filename = rpm_name
+    if rpm_name.endswith('.rpm'):
+        filename = rpm_name[:-4]
+
+    rest, _, arch = filename.rpartition('.')
+    rest, _, release = rest.rpartition('-')
+    name, _, version = rest.rpartition('-')
+    epoch = None
+    if ':' in name:
+        epoch, _, name = name.partition(':')
+    elif ':' in version:
+        epoch, _, version = version.partition(':')
+    if name and version and release and arch and ':' not in name + version + release \
+            and (epoch is None or (epoch.isascii() and epoch.isdigit())) and ARCH_CHARS.issuperset(arch):
+        return name
+
+    match = NEVRA_RE.match(filename)
+    return match.group('pn') if match else ''
+
+
+def extended_request(vmaas_json):
+    """
+    Set "extended" flag directly in stored vmaas request JSON to avoid decoding and encoding it again.
+    """
+    head = vmaas_json.rstrip()[:-1].rstrip()
+    separator = "" if head.endswith("{") else ","
+    body = f'{head}{separator}"extended":true}}'.encode("utf-8")
+    if VMAAS_GZIP:
+        body = gzip.compress(body, compresslevel=1)
+    return body
+
+
 class SqliteConnection:
-    def __init__(self, db_file_name: str):
+    def __init__(self, db_file_name: str, read_only: bool = False):
         self.db_file_name = db_file_name
+        self.read_only = read_only
         self.con = None
 
     def __enter__(self) -> sqlite3.Connection:
         self.con = sqlite3.connect(self.db_file_name)
-        self.con.execute("PRAGMA foreign_keys = ON")  # Enforce foreign keys
+        if self.read_only:
+            self.con.execute("PRAGMA query_only = ON")
+            self.con.execute("PRAGMA mmap_size = 268435456")  # 256 MiB memory-mapped I/O
+            self.con.execute("PRAGMA cache_size = -262144")  # 256 MiB page cache
+        else:
+            self.con.execute("PRAGMA foreign_keys = ON")  # Enforce foreign keys
+            self.con.execute("PRAGMA journal_mode = WAL")
+            self.con.execute("PRAGMA synchronous = NORMAL")  # Safe with WAL, no fsync per commit
+            self.con.execute("PRAGMA temp_store = MEMORY")
         return self.con
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -64,12 +130,12 @@ class SqliteConnection:
 
 
 class SqliteCursor:
-    def __init__(self, sqlite_connection: SqliteConnection):
+    def __init__(self, sqlite_connection: sqlite3.Connection):
         self.con = sqlite_connection
         self.cur = None
 
     def __enter__(self) -> sqlite3.Cursor:
-        self.cur = sqlite3.Cursor(self.con)
+        self.cur = self.con.cursor()
         return self.cur
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -78,82 +144,117 @@ class SqliteCursor:
             self.cur = None
 
 
+def count_systems(cur, system_limit):
+    """
+    Get upper bound of number of systems the queries below can return.
+    Counting all rows only reads the inventory_id index, filtering out empty profiles would read all profiles.
+    """
+    cur.execute("SELECT COUNT(*) FROM system")
+    return min(system_limit, cur.fetchone()[0])
+
+
+def systems(cur, system_limit):
+    """
+    Yield inventory ID, package count, RHEL repositories and encoded vmaas request of each system with a profile.
+    """
+    cur.execute("SELECT inventory_id, vmaas_json FROM system ORDER by inventory_id LIMIT ?", (system_limit,))
+    for inventory_id, vmaas_json in cur:
+        if vmaas_json != "":
+            request = orjson.loads(vmaas_json)
+            total_packages = len(request["package_list"])
+            repository_list = [repo for repo in request.get('repository_list', []) if repo.startswith("rhel")]
+            yield inventory_id, total_packages, repository_list, extended_request(vmaas_json)
+
+
+def evaluate(system):
+    """
+    Get CVE counts and unfixed packages breakdown of the system from vmaas, None if the request failed.
+    Only these are kept from the response, so batch results don't hold whole response documents.
+    """
+    *_, body = system
+    resp = SESSION.post(VMAAS_URL, data=body, headers=JSON_HEADERS)
+    if resp.status_code != 200:
+        return None
+    vulns = orjson.loads(resp.content)
+    unfixed_breakdown = Counter()
+    for unfixed_cve in vulns['unpatched_cve_list']:
+        unfixed_breakdown.update(parse_rpm_name_only(affected_package)
+                                 for affected_package in unfixed_cve['affected_packages'])
+    return len(vulns['cve_list']), len(vulns['manually_fixable_cve_list']), len(vulns['unpatched_cve_list']), unfixed_breakdown
+
+
+def evaluate_all(pool, systems):
+    """
+    Evaluate systems in concurrent batches and yield them with their results in original order.
+    """
+    batch = []
+    for system in systems:
+        batch.append(system)
+        if len(batch) == BATCH_SIZE:
+            yield from zip(batch, pool.map(evaluate, batch))
+            batch = []
+    yield from zip(batch, pool.map(evaluate, batch))
+
+
 def main():
-    if len(sys.argv) != 3:
+    if len(sys.argv) != 3 or not sys.argv[2].isdecimal():
         print(f"Usage: {sys.argv[0]} <sqlite_file> <limit>", file=sys.stderr)
         sys.exit(1)
     sqlite_file = sys.argv[1]
-    system_limit = sys.argv[2]
+    system_limit = int(sys.argv[2])
 
-    playbook_cves_stats = []
-    manual_cves_stats = []
-    unfixed_cves_stats = []
-    unfixed_packages_stats = []
-    total_packages_stats = []
+    evaluated = 0
 
-    with SqliteConnection(sqlite_file) as con:
+    with SqliteConnection(sqlite_file, read_only=True) as con:
         with SqliteCursor(con) as cur:
             try:
-                cur.execute(f"SELECT inventory_id, vmaas_json FROM system ORDER by inventory_id LIMIT {system_limit}")
-                system = cur.fetchone()
-                while system:
-                    inventory_id, vmaas_json = system
-                    if vmaas_json == "":
-                        system = cur.fetchone()
-                        continue
-                    vmaas_json = json.loads(vmaas_json)
-                    vmaas_json["extended"] = True
-                    total_packages = len(vmaas_json["package_list"])
-                    repository_list = [repo for repo in vmaas_json.get('repository_list', []) if repo.startswith("rhel")]
-                    resp = requests.post(VMAAS_URL, json=vmaas_json)
-                    if resp.status_code != 200:
-                        system = cur.fetchone()
-                        continue
-                    vulns = resp.json()
-                    playbook_cves = len(vulns['cve_list'])
-                    manual_cves = len(vulns['manually_fixable_cve_list'])
-                    unfixed_cves = len(vulns['unpatched_cve_list'])
-                    unfixed_breakdown = {}
-                    for unfixed_cve in vulns['unpatched_cve_list']:
-                        for affected_package in unfixed_cve['affected_packages']:
-                            nevra = parse_rpm_name(affected_package)
-                            name = nevra[0]
-                            if name not in unfixed_breakdown:
-                                unfixed_breakdown[name] = 0
-                            unfixed_breakdown[name] += 1
-                    unfixed_breakdown = tuple(unfixed_breakdown.items())
-                    unfixed_packages = len(unfixed_breakdown)
-                    print(f"{inventory_id}: " \
-                            f"repos={repository_list}, " \
-                            f"playbook_cves={playbook_cves}, " \
-                            f"manual_cves={manual_cves}, " \
-                            f"unfixed_cves={unfixed_cves}, " \
-                            f"unfixed_pkgs={unfixed_packages}, " \
-                            f"total_pkgs={total_packages}, " \
-                            f"unfixed_pkgs_breakdown={sorted(unfixed_breakdown, key=lambda x: x[1], reverse=True)}" \
-                            )
-                    playbook_cves_stats.append(playbook_cves)
-                    manual_cves_stats.append(manual_cves)
-                    unfixed_cves_stats.append(unfixed_cves)
-                    unfixed_packages_stats.append(unfixed_packages)
-                    total_packages_stats.append(total_packages)
-                    system = cur.fetchone()
+                system_count = count_systems(cur, system_limit)
+                playbook_cves_stats = np.empty(system_count, dtype=np.int64)
+                manual_cves_stats = np.empty(system_count, dtype=np.int64)
+                unfixed_cves_stats = np.empty(system_count, dtype=np.int64)
+                unfixed_packages_stats = np.empty(system_count, dtype=np.int64)
+                total_packages_stats = np.empty(system_count, dtype=np.int64)
+                with ThreadPoolExecutor(max_workers=BATCH_SIZE) as pool:
+                    for (inventory_id, total_packages, repository_list, _), result in evaluate_all(pool, systems(cur, system_limit)):
+                        if result is None:
+                            continue
+                        playbook_cves, manual_cves, unfixed_cves, unfixed_breakdown = result
+                        unfixed_packages = len(unfixed_breakdown)
+                        print(f"{inventory_id}: " \
+                                f"repos={repository_list}, " \
+                                f"playbook_cves={playbook_cves}, " \
+                                f"manual_cves={manual_cves}, " \
+                                f"unfixed_cves={unfixed_cves}, " \
+                                f"unfixed_pkgs={unfixed_packages}, " \
+                                f"total_pkgs={total_packages}, " \
+                                f"unfixed_pkgs_breakdown={sorted(unfixed_breakdown.items(), key=itemgetter(1), reverse=True)}" \
+                                )
+                        playbook_cves_stats[evaluated] = playbook_cves
+                        manual_cves_stats[evaluated] = manual_cves
+                        unfixed_cves_stats[evaluated] = unfixed_cves
+                        unfixed_packages_stats[evaluated] = unfixed_packages
+                        total_packages_stats[evaluated] = total_packages
+                        evaluated += 1
 
             except sqlite3.DatabaseError as e:
                 con.rollback()
                 print("Error occured during querying DB: \"%s\"" % e)
 
+            if evaluated == 0:
+                print("No systems evaluated!", file=sys.stderr)
+                sys.exit(2)
+
             print("")
-            print(f"total playbook cves: {sum(playbook_cves_stats)}")
-            print(f"average playbook cves per system: {sum(playbook_cves_stats)/len(playbook_cves_stats)}")
-            print(f"total manual cves: {sum(manual_cves_stats)}")
-            print(f"average manual cves per system: {sum(manual_cves_stats)/len(manual_cves_stats)}")
-            print(f"total unfixed cves: {sum(unfixed_cves_stats)}")
-            print(f"average unfixed cves per system: {sum(unfixed_cves_stats)/len(unfixed_cves_stats)}")
-            print(f"total unfixed packages: {sum(unfixed_packages_stats)}")
-            print(f"average unfixed packages per system: {sum(unfixed_packages_stats)/len(unfixed_packages_stats)}")
-            print(f"total packages: {sum(total_packages_stats)}")
-            print(f"average packages per system: {sum(total_packages_stats)/len(total_packages_stats)}")
+            print(f"total playbook cves: {playbook_cves_stats[:evaluated].sum()}")
+            print(f"average playbook cves per system: {playbook_cves_stats[:evaluated].sum()/evaluated}")
+            print(f"total manual cves: {manual_cves_stats[:evaluated].sum()}")
+            print(f"average manual cves per system: {manual_cves_stats[:evaluated].sum()/evaluated}")
+            print(f"total unfixed cves: {unfixed_cves_stats[:evaluated].sum()}")
+            print(f"average unfixed cves per system: {unfixed_cves_stats[:evaluated].sum()/evaluated}")
+            print(f"total unfixed packages: {unfixed_packages_stats[:evaluated].sum()}")
+            print(f"average unfixed packages per system: {unfixed_packages_stats[:evaluated].sum()/evaluated}")
+            print(f"total packages: {total_packages_stats[:evaluated].sum()}")
+            print(f"average packages per system: {total_packages_stats[:evaluated].sum()/evaluated}")
 
 
 if __name__ == "__main__":
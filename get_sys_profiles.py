@@ -5,11 +5,21 @@ import os
 import sqlite3
 import sys
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
 
 GABI_URL = os.getenv("GABI_URL", "")
 GABI_TOKEN = os.getenv("GABI_TOKEN", "")
 
-HEADERS = {"Authorization": f"Bearer {GABI_TOKEN}"}
+HEADERS = {"Authorization": f"Bearer {GABI_TOKEN}", "Content-Type": "application/json"}
+
+PAGE_SIZE = 100  # Systems queried from gabi at once
+COMMIT_PAGES = 50  # Pages inserted to DB in one transaction
+
+# Keep-Alive session so the TLS handshake is done only once for all page queries
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
 
 TABLES = {
     "system":
@@ -23,13 +33,22 @@ TABLES = {
 
 
 class SqliteConnection:
-    def __init__(self, db_file_name: str):
+    def __init__(self, db_file_name: str, read_only: bool = False):
         self.db_file_name = db_file_name
+        self.read_only = read_only
         self.con = None
 
     def __enter__(self) -> sqlite3.Connection:
         self.con = sqlite3.connect(self.db_file_name)
-        self.con.execute("PRAGMA foreign_keys = ON")  # Enforce foreign keys
+        if self.read_only:
+            self.con.execute("PRAGMA query_only = ON")
+            self.con.execute("PRAGMA mmap_size = 268435456")  # 256 MiB memory-mapped I/O
+            self.con.execute("PRAGMA cache_size = -262144")  # 256 MiB page cache
+        else:
+            self.con.execute("PRAGMA foreign_keys = ON")  # Enforce foreign keys
+            self.con.execute("PRAGMA journal_mode = WAL")
+            self.con.execute("PRAGMA synchronous = NORMAL")  # Safe with WAL, no fsync per commit
+            self.con.execute("PRAGMA temp_store = MEMORY")
         return self.con
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -39,12 +58,12 @@ class SqliteConnection:
 
 
 class SqliteCursor:
-    def __init__(self, sqlite_connection: SqliteConnection):
+    def __init__(self, sqlite_connection: sqlite3.Connection):
         self.con = sqlite_connection
         self.cur = None
 
     def __enter__(self) -> sqlite3.Cursor:
-        self.cur = sqlite3.Cursor(self.con)
+        self.cur = self.con.cursor()
         return self.cur
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -55,25 +74,37 @@ class SqliteCursor:
 
 def query(query):
     tries = 0
-    data = {"query": query}
+    data = orjson.dumps({"query": query})
     while tries <= 5:
-        r = requests.post(GABI_URL, headers=HEADERS, json=data)
+        r = SESSION.post(GABI_URL, headers=HEADERS, data=data)
         if r.status_code == 200:
-            return r.json()["result"]
+            return orjson.loads(r.content)["result"]
         else:
             print(f"Query failed: {query}, HTTP code: {r.status_code}", file=sys.stderr)
             tries += 1
     sys.exit(3)
 
 
+def id_filter(last_id):
+    return "" if last_id is None else f" WHERE id > {last_id}"
+
+
+def query_page(last_id):
+    """
+    Query next page of systems after last_id using keyset pagination.
+    """
+    return query(f"SELECT id, inventory_id, vmaas_json FROM system_platform{id_filter(last_id)} ORDER BY id LIMIT {PAGE_SIZE};")
+
+
 def main():
     if not GABI_URL or not GABI_TOKEN:
         print("GABI_URL or GABI_TOKEN env variable not defined!", file=sys.stderr)
         sys.exit(1)
-    if len(sys.argv) != 2:
-        print(f"Usage: {sys.argv[0]} <sqlite_file>", file=sys.stderr)
+    if len(sys.argv) not in (2, 3) or (len(sys.argv) == 3 and not sys.argv[2].isdecimal()):
+        print(f"Usage: {sys.argv[0]} <sqlite_file> [<last_id>]", file=sys.stderr)
         sys.exit(2)
     sqlite_file = sys.argv[1]
+    last_id = int(sys.argv[2]) if len(sys.argv) == 3 else None
 
     print(f"Gabi URL: {GABI_URL}")
     print(f"Gabi token: ***")
@@ -88,15 +119,25 @@ def main():
                 con.commit()
                 print("DB schema initialization completed")
 
-                number_of_sys = int(query(f"SELECT COUNT(*) FROM system_platform;")[1][0])
+                number_of_sys = int(query(f"SELECT COUNT(*) FROM system_platform{id_filter(last_id)};")[1][0])
                 print(f"Systems: {number_of_sys}")
 
-                pages = math.floor(number_of_sys/100)
-                for i in range(9700,pages):
-                    chunk = query(f"SELECT inventory_id, vmaas_json FROM system_platform ORDER BY id LIMIT 100 OFFSET {i*100};")
-                    cur.executemany("INSERT INTO system (inventory_id, vmaas_json) VALUES (?, ?) ON CONFLICT DO NOTHING", chunk[1:])
-                    con.commit()
-                    print(f"{i+1}/{pages} done")
+                pages = math.ceil(number_of_sys/PAGE_SIZE)
+                page = 0
+                while True:
+                    chunk = query_page(last_id)[1:]
+                    if not chunk:
+                        break
+                    last_id = int(chunk[-1][0])
+                    cur.executemany("INSERT INTO system (inventory_id, vmaas_json) VALUES (?, ?) ON CONFLICT DO NOTHING",
+                                    [row[1:] for row in chunk])
+                    page += 1
+                    print(f"{page}/{pages} done")
+                    if page % COMMIT_PAGES == 0:
+                        con.commit()
+                        print(f"Committed, last id: {last_id}")
+                con.commit()
+                print(f"Committed, last id: {last_id}")
 
             except sqlite3.DatabaseError as e:
                 con.rollback()